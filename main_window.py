@@ -1,4 +1,4 @@
-import sys, os, wave, logging, hashlib, math
+import sys, os, wave, json, time, logging, hashlib, math
 from pathlib import Path
 from pinyin import pinyin
 from pydub import AudioSegment
@@ -20,7 +20,7 @@ from PyQt5.QtWidgets import (
 )
 from PyQt5.QtGui import (QPainter, QColor, QBrush, QPen, QFont, QKeySequence, QIcon)
 from PyQt5.QtCore import (Qt, QRectF, QMimeData, QThread, pyqtSignal, QUrl, QTimer, QPointF)
-from PyQt5.QtMultimedia import QMediaPlayer, QSoundEffect, QMediaContent
+from PyQt5.QtMultimedia import QMediaPlayer, QSoundEffect, QMediaContent, QAudio, QAudioOutput, QAudioFormat, QAudioDeviceInfo
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -30,6 +30,102 @@ class ModelNotFoundError(Exception):
     """当模型文件在指定目录未找到时抛出此异常。"""
     pass
 
+# --- 规范化音频格式 ---
+# 素材在入库时统一转换为该格式（48 kHz / 单声道 / int16），合成时即可按采样直接叠加，无需重采样
+CANONICAL_FORMAT = {'frame_rate': 48000, 'channels': 1, 'sample_width': 2}
+FORMAT_METADATA_FILE = 'format.json'
+
+def normalize_audio(audio, fmt=CANONICAL_FORMAT):
+    """将音频转换为指定的规范格式，已是该格式时不做任何处理。"""
+    return (audio.set_frame_rate(fmt['frame_rate'])
+                 .set_channels(fmt['channels'])
+                 .set_sample_width(fmt['sample_width']))
+
+def is_canonical_wav(file_path, fmt=CANONICAL_FORMAT):
+    """仅读取 WAV 文件头判断其是否已是规范格式。"""
+    try:
+        with wave.open(file_path, 'rb') as wf:
+            return (wf.getframerate(), wf.getnchannels(), wf.getsampwidth()) == \
+                   (fmt['frame_rate'], fmt['channels'], fmt['sample_width'])
+    except Exception:
+        return False
+
+def list_clips(project_path):
+    return sorted(f for f in os.listdir(project_path) if f.lower().endswith(".wav"))
+
+def write_format_metadata(project_path, fmt=CANONICAL_FORMAT):
+    """在项目目录中记录素材片段的音频格式及已确认符合该格式的片段列表；没有片段时不记录。"""
+    clips = list_clips(project_path)
+    if not clips: return
+    with open(os.path.join(project_path, FORMAT_METADATA_FILE), 'w', encoding='utf-8') as f:
+        json.dump(dict(fmt, clips=clips), f, ensure_ascii=False)
+
+def is_project_normalized(project_path, fmt=CANONICAL_FORMAT):
+    """format.json 与 fmt 一致、片段列表未变且没有比它更新的片段时，可跳过逐个文件检查。"""
+    metadata_path = os.path.join(project_path, FORMAT_METADATA_FILE)
+    try:
+        with open(metadata_path, encoding='utf-8') as f:
+            metadata = json.load(f)
+        metadata_mtime = os.path.getmtime(metadata_path)
+    except (OSError, ValueError):
+        return False
+    clips = list_clips(project_path)
+    return (all(metadata.get(k) == v for k, v in fmt.items())
+            and metadata.get('clips') == clips
+            and all(os.path.getmtime(os.path.join(project_path, c)) <= metadata_mtime for c in clips))
+
+def load_clip(file_path, fmt=CANONICAL_FORMAT):
+    """读取素材片段；未规范化的片段（如手动放入的文件）会在内存中转换并给出提示。"""
+    audio = AudioSegment.from_file(file_path, format="wav")
+    if (audio.frame_rate, audio.channels, audio.sample_width) != \
+       (fmt['frame_rate'], fmt['channels'], fmt['sample_width']):
+        logger.warning(f"Clip is not in canonical format, converting on the fly: {file_path}")
+        audio = normalize_audio(audio, fmt)
+    return audio
+
+def normalize_library(base_dir, fmt=CANONICAL_FORMAT, progress_callback=None):
+    """批量将素材库中所有项目的片段转换为规范格式，返回 (转换数量, 片段总数, 失败片段列表)。"""
+    project_paths = [os.path.join(base_dir, d) for d in sorted(os.listdir(base_dir))
+                     if os.path.isdir(os.path.join(base_dir, d))]
+    project_clips = {p: list_clips(p) for p in project_paths}
+    total = sum(len(clips) for clips in project_clips.values())
+    done = 0
+    converted = 0
+    failed = []
+    for project_path, clips in project_clips.items():
+        if is_project_normalized(project_path, fmt):
+            done += len(clips)
+            if progress_callback and clips:
+                progress_callback(done, total)
+            continue
+        project_failed = False
+        for clip_name in clips:
+            clip_path = os.path.join(project_path, clip_name)
+            if not is_canonical_wav(clip_path, fmt):
+                # 先写入同目录下的临时文件再替换，导出失败时不会损坏原片段
+                temp_path = clip_path + '.tmp'
+                try:
+                    normalize_audio(AudioSegment.from_file(clip_path), fmt).export(temp_path, format='wav')
+                    os.replace(temp_path, clip_path)
+                    converted += 1
+                except Exception as e:
+                    logger.warning(f"Could not normalize {clip_path}: {e}")
+                    failed.append(clip_path)
+                    project_failed = True
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            done += 1
+            if progress_callback:
+                progress_callback(done, total)
+        metadata_path = os.path.join(project_path, FORMAT_METADATA_FILE)
+        if not project_failed:
+            write_format_metadata(project_path, fmt)
+        elif os.path.exists(metadata_path):
+            # 仍有未转换片段的项目不能保留过期的格式记录
+            os.remove(metadata_path)
+    logger.info(f"Normalized library {base_dir}: converted {converted}/{total} clips, {len(failed)} failed.")
+    return converted, total, failed
+
 class AudioProcessor:
     def __init__(self, model_size: str = 'base', device: str = 'auto', compute_type: str = 'default'):
         if sys.platform == 'darwin':
@@ -68,7 +164,8 @@ class AudioProcessor:
         segments, info = self.model.transcribe(input_path, word_timestamps=True, language='zh')
         logger.info(f"Transcribed: {info.language} ({info.language_probability:.2f})")
         
-        audio = AudioSegment.from_file(input_path)
+        # 只对源文件转换一次，切出的片段自然都是规范格式
+        audio = normalize_audio(AudioSegment.from_file(input_path))
         processed_intervals = []
         words_to_process = []
         all_words = []
@@ -91,6 +188,7 @@ class AudioProcessor:
             audio[start_ms:end_ms].export(output_filepath, format='wav')
             if progress_callback:
                 progress_callback(i + 1, len(words_to_process))
+        write_format_metadata(str(output_path))
                 
         logger.info(f"Finished processing. Generated {len(words_to_process)} clips.")
         return str(output_path)
@@ -135,6 +233,30 @@ class ProcessingThread(QThread):
             logger.error(f"处理错误: {e}", exc_info=True)
             self.processing_error.emit(f"处理错误: {str(e)}")
 
+class NormalizationThread(QThread):
+    progress_updated = pyqtSignal(int)
+    normalization_finished = pyqtSignal(str)
+    normalization_error = pyqtSignal(str)
+
+    def __init__(self, base_dir):
+        super().__init__()
+        self.base_dir = base_dir
+
+    def run(self):
+        try:
+            def progress_callback(current, total):
+                if total > 0:
+                    self.progress_updated.emit(int((current / total) * 100))
+
+            converted, total, failed = normalize_library(self.base_dir, progress_callback=progress_callback)
+            message = f"规范化完成，共 {total} 个片段，转换了 {converted} 个"
+            if failed:
+                message += f"，{len(failed)} 个失败: " + ", ".join(os.path.basename(f) for f in failed)
+            self.normalization_finished.emit(message)
+        except Exception as e:
+            logger.error(f"规范化错误: {e}", exc_info=True)
+            self.normalization_error.emit(f"规范化错误: {str(e)}")
+
 class MaterialLibrary(QTreeWidget):
     def __init__(self, parent=None):
         super().__init__(parent); self.setHeaderHidden(True); self.setDragEnabled(True)
@@ -166,6 +288,8 @@ class AudioBlockItem(QGraphicsRectItem):
         font = QFont(); font.setPointSize(10)
         self.text_item.setFont(font)
         self.text_item.setPos(self.rect().topLeft() + QPointF(5, 5))
+        # 预先缓存片段 PCM，拖动播放头试听时无需再读盘
+        self.timeline_view.main_window.get_clip(self.file_path)
 
     def check_collision(self, target_rect):
         other_items = [item for item in self.scene().items()
@@ -235,7 +359,9 @@ class AudioBlockItem(QGraphicsRectItem):
     def contextMenuEvent(self, event):
         menu = QMenu(); copy_action = menu.addAction("复制"); delete_action = menu.addAction("删除")
         action = menu.exec_(event.screenPos())
-        if action == delete_action: self.scene().removeItem(self)
+        if action == delete_action:
+            self.scene().removeItem(self)
+            self.timeline_view.main_window.prune_clip_cache()
         elif action == copy_action:
             base_width = self.rect().width() / self.timeline_view.pixels_per_second * 100.0
             self.timeline_view.main_window.copied_block_data = {"file_path": self.file_path, "base_width": base_width}
@@ -269,6 +395,100 @@ class RulerWidget(QWidget):
                 painter.drawText(QPointF(pixel_pos + 4, 15), time_str)
             current_sec += step
 
+class AudioScrubber:
+    """拖动播放头时，从缓存的片段 PCM 即时混合播放头附近的短窗口，并通过低延迟输出播放。"""
+    CHUNK_MS = 20       # 单次输出的最长时长
+    BUFFER_MS = 30      # 输出缓冲上限，决定声音相对光标的最大延迟
+    MIN_SPEED = 0.25
+    MAX_SPEED = 4.0
+
+    def __init__(self, timeline_view):
+        self.timeline_view = timeline_view
+        audio_format = QAudioFormat()
+        audio_format.setSampleRate(CANONICAL_FORMAT['frame_rate'])
+        audio_format.setChannelCount(CANONICAL_FORMAT['channels'])
+        audio_format.setSampleSize(CANONICAL_FORMAT['sample_width'] * 8)
+        audio_format.setCodec("audio/pcm")
+        audio_format.setByteOrder(QAudioFormat.LittleEndian)
+        audio_format.setSampleType(QAudioFormat.SignedInt)
+        self.device = None
+        self.last_seconds = None
+        self.last_time = None
+        self.audio_output = None
+        device_info = QAudioDeviceInfo.defaultOutputDevice()
+        if not device_info.isFormatSupported(audio_format):
+            audio_format = device_info.nearestFormat(audio_format)
+            # 只接受可由 pydub 直接生成的有符号小端 PCM，否则禁用试听
+            if not (audio_format.codec() == "audio/pcm" and audio_format.sampleType() == QAudioFormat.SignedInt
+                    and audio_format.byteOrder() == QAudioFormat.LittleEndian and audio_format.sampleSize() in (16, 32)):
+                logger.warning("Default output device supports no usable PCM format, scrubbing disabled.")
+                return
+            logger.info(f"Canonical format not supported by output device, scrubbing at "
+                        f"{audio_format.sampleRate()} Hz / {audio_format.channelCount()} ch / {audio_format.sampleSize()} bit.")
+        self.output_format = {'frame_rate': audio_format.sampleRate(), 'channels': audio_format.channelCount(),
+                              'sample_width': audio_format.sampleSize() // 8}
+        self.frame_width = self.output_format['channels'] * self.output_format['sample_width']
+        self.audio_output = QAudioOutput(audio_format)
+        self.audio_output.setBufferSize(int(self.output_format['frame_rate'] * self.BUFFER_MS / 1000) * self.frame_width)
+
+    def start(self, seconds):
+        if self.audio_output is None: return
+        if self.device is None:
+            self.device = self.audio_output.start()
+            if self.audio_output.error() != QAudio.NoError:
+                logger.warning(f"Could not open audio output (error {self.audio_output.error()}), scrubbing disabled.")
+                self.audio_output = None
+                self.device = None
+                return
+        self.last_seconds = seconds
+        self.last_time = time.perf_counter()
+
+    def stop(self):
+        self.last_seconds = None
+        self.last_time = None
+
+    def render_window(self, start_ms, duration_ms):
+        """混合 [start_ms, start_ms + duration_ms) 范围内所有音频块，只查询与该范围相交的块。"""
+        view = self.timeline_view
+        pps = view.pixels_per_second
+        output = normalize_audio(AudioSegment.silent(duration=duration_ms, frame_rate=CANONICAL_FORMAT['frame_rate']))
+        window_rect = QRectF(start_ms / 1000.0 * pps, 0, max(1.0, duration_ms / 1000.0 * pps),
+                             view.TRACK_COUNT * view.TRACK_HEIGHT)
+        for item in view.scene.items(window_rect):
+            if not isinstance(item, AudioBlockItem): continue
+            clip = view.main_window.get_clip(item.file_path)
+            if clip is None: continue
+            offset_ms = start_ms - int(item.x() / pps * 1000)
+            piece = clip[max(0, offset_ms):offset_ms + duration_ms]
+            if len(piece) > 0:
+                output = output.overlay(piece, position=max(0, -offset_ms))
+        return output
+
+    def scrub_to(self, seconds):
+        if self.audio_output is None or self.device is None or self.last_seconds is None: return
+        now = time.perf_counter()
+        elapsed_ms = (now - self.last_time) * 1000
+        out_ms = min(elapsed_ms, self.CHUNK_MS)
+        span_ms = (seconds - self.last_seconds) * 1000
+        self.last_seconds, self.last_time = seconds, now
+        if span_ms == 0 or out_ms < 1: return
+        # 播放速度按真实耗时计算以跟随拖动速度；窗口始终贴着光标：向前拖听光标之前的声音，向后拖则倒放光标之后的声音
+        speed = max(self.MIN_SPEED, min(abs(span_ms) / elapsed_ms, self.MAX_SPEED))
+        source_ms = max(1, int(out_ms * speed))
+        cursor_ms = int(seconds * 1000)
+        if span_ms > 0:
+            chunk = self.render_window(max(0, cursor_ms - source_ms), source_ms)
+        else:
+            chunk = self.render_window(cursor_ms, source_ms).reverse()
+        frame_rate = CANONICAL_FORMAT['frame_rate']
+        chunk = normalize_audio(chunk._spawn(chunk.raw_data, overrides={'frame_rate': int(frame_rate * speed)}),
+                                self.output_format)
+        # 放不进缓冲的部分直接丢弃，只保留最靠近光标的末尾帧，并按帧对齐以免样本错位
+        free_bytes = self.audio_output.bytesFree()
+        free_bytes -= free_bytes % self.frame_width
+        if free_bytes > 0:
+            self.device.write(chunk.raw_data[-free_bytes:])
+
 class TimelineView(QGraphicsView):
     TRACK_COUNT = 5; TRACK_HEIGHT = 60
     def __init__(self, main_window, parent=None):
@@ -305,17 +525,20 @@ class TimelineView(QGraphicsView):
             self._is_dragging_playhead = True
             scene_pos = self.mapToScene(event.pos())
             self.set_playhead_position(scene_pos.x())
+            self.main_window.scrubber.start(self.playhead.x() / self.pixels_per_second)
         else:
             super().mousePressEvent(event)
     def mouseMoveEvent(self, event):
         if self._is_dragging_playhead:
             scene_pos = self.mapToScene(event.pos())
             self.set_playhead_position(scene_pos.x())
+            self.main_window.scrubber.scrub_to(self.playhead.x() / self.pixels_per_second)
         else:
             super().mouseMoveEvent(event)
     def mouseReleaseEvent(self, event):
         if self._is_dragging_playhead:
             self._is_dragging_playhead = False
+            self.main_window.scrubber.stop()
         super().mouseReleaseEvent(event)
     def keyPressEvent(self, event):
         if event.matches(QKeySequence.Paste):
@@ -361,6 +584,7 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("Audio Mova 活字乱刷术")
         self.setGeometry(100, 100, 1400, 800)
         self.copied_block_data = None
+        self.clip_cache = {}
         self.setup_ui()
         self.setup_player()
         if sys.platform == 'darwin':
@@ -368,6 +592,7 @@ class MainWindow(QMainWindow):
         else:
             self.setWindowIcon(QIcon(resource_path('icons/icon.png')))
         self.processing_thread = None
+        self.normalization_thread = None
 
     def setup_ui(self):
         central_widget = QWidget()
@@ -510,9 +735,12 @@ class MainWindow(QMainWindow):
         try:
             max_x = max(item.x() + item.rect().width() for item in all_blocks) if all_blocks else 0
             total_duration_ms = int((max_x / self.timeline_view.pixels_per_second) * 1000) + 100
-            output_audio = AudioSegment.silent(duration=total_duration_ms)
+            output_audio = normalize_audio(AudioSegment.silent(duration=total_duration_ms, frame_rate=CANONICAL_FORMAT['frame_rate']))
             for item in all_blocks:
-                block_audio = AudioSegment.from_file(item.file_path, format="wav")
+                block_audio = self.get_clip(item.file_path)
+                if block_audio is None:
+                    # 缓存中记录为读取失败的片段在导出时重新读取一次，以便报告具体错误
+                    block_audio = load_clip(item.file_path)
                 start_pos_ms = int((item.x() / self.timeline_view.pixels_per_second) * 1000)
                 output_audio = output_audio.overlay(block_audio, position=start_pos_ms)
             return output_audio, True
@@ -520,6 +748,28 @@ class MainWindow(QMainWindow):
             logger.error(f"合成音频时出错: {e}", exc_info=True)
             return f"合成失败: {str(e)}", False
             
+    def get_clip(self, file_path):
+        """返回缓存的片段 PCM；读取失败的片段缓存为 None，避免拖动时反复读盘。"""
+        if file_path not in self.clip_cache:
+            try:
+                self.clip_cache[file_path] = load_clip(file_path)
+            except Exception as e:
+                logger.warning(f"Could not load clip {file_path}: {e}")
+                self.clip_cache[file_path] = None
+        return self.clip_cache[file_path]
+
+    def rebuild_clip_cache(self):
+        """丢弃全部缓存，并重新加载时间轴上仍在使用的片段，使磁盘上被替换的文件生效。"""
+        self.clip_cache = {}
+        for item in self.timeline_view.scene.items():
+            if isinstance(item, AudioBlockItem):
+                self.get_clip(item.file_path)
+
+    def prune_clip_cache(self):
+        used_paths = {item.file_path for item in self.timeline_view.scene.items() if isinstance(item, AudioBlockItem)}
+        for file_path in [p for p in self.clip_cache if p not in used_paths]:
+            del self.clip_cache[file_path]
+
     def create_menu_bar(self):
         menu_bar = self.menuBar()
         file_menu = menu_bar.addMenu("文件")
@@ -527,6 +777,8 @@ class MainWindow(QMainWindow):
         import_action.triggered.connect(self.browse_input_file)
         export_action = file_menu.addAction("导出音频...")
         export_action.triggered.connect(self.export_timeline)
+        self.normalize_action = file_menu.addAction("规范化素材库")
+        self.normalize_action.triggered.connect(self.start_normalization)
         help_menu = menu_bar.addMenu("帮助")
         about_action = help_menu.addAction("关于")
         about_action.triggered.connect(self.show_about_dialog) 
@@ -578,6 +830,7 @@ class MainWindow(QMainWindow):
         self.playback_timer = QTimer(self)
         self.playback_timer.setInterval(30)
         self.playback_timer.timeout.connect(self.update_playhead_on_playback)
+        self.scrubber = AudioScrubber(self.timeline_view)
 
     def stop_timeline(self):
         self.media_player.stop()
@@ -601,6 +854,7 @@ class MainWindow(QMainWindow):
         self.time_label.setText(f"{int(mins):02d}:{int(secs):02d}.{int(msecs):03d}")
 
     def refresh_material_library(self):
+        self.rebuild_clip_cache()
         self.material_library.clear()
         base_dir = self.output_dir_edit.text()
         if not os.path.isdir(base_dir): return
@@ -643,6 +897,7 @@ class MainWindow(QMainWindow):
             return
         
         self.process_btn.setEnabled(False)
+        self.normalize_action.setEnabled(False)
         self.statusBar().showMessage("正在准备处理，可能需要下载模型...")
         self.progress_bar.setValue(0)
         self.progress_bar.setFormat("%p%")
@@ -657,9 +912,36 @@ class MainWindow(QMainWindow):
         self.processing_thread.processing_finished.connect(self.processing_complete)
         self.processing_thread.processing_error.connect(self.show_error_message)
         self.processing_thread.finished.connect(lambda: self.process_btn.setEnabled(True))
+        self.processing_thread.finished.connect(lambda: self.normalize_action.setEnabled(True))
         
         self.processing_thread.start()
 
+    def start_normalization(self):
+        # 处理或规范化线程仍在运行时不能再启动，否则两个线程会同时改写同一批文件
+        if any(t is not None and t.isRunning() for t in (self.processing_thread, self.normalization_thread)):
+            self.statusBar().showMessage("请等待当前任务完成。")
+            return
+        base_dir = self.output_dir_edit.text()
+        if not os.path.isdir(base_dir):
+            self.statusBar().showMessage("错误：输出目录不存在。")
+            return
+        self.process_btn.setEnabled(False)
+        self.normalize_action.setEnabled(False)
+        self.statusBar().showMessage("正在规范化素材库...")
+        self.progress_bar.setValue(0)
+        self.normalization_thread = NormalizationThread(base_dir)
+        self.normalization_thread.progress_updated.connect(self.progress_bar.setValue)
+        self.normalization_thread.normalization_finished.connect(self.normalization_complete)
+        self.normalization_thread.normalization_error.connect(self.show_error_message)
+        self.normalization_thread.finished.connect(lambda: self.process_btn.setEnabled(True))
+        self.normalization_thread.finished.connect(lambda: self.normalize_action.setEnabled(True))
+        self.normalization_thread.start()
+
+    def normalization_complete(self, message):
+        self.statusBar().showMessage(message)
+        self.progress_bar.setValue(100)
+        self.refresh_material_library()
+
     def processing_complete(self, message):
         self.statusBar().showMessage(message)
         if "处理完成" in message or "目录已存在" in message: